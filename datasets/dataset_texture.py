@@ -4,8 +4,6 @@ from typing import List
 import cv2
 import numpy as np
 import torch
-from PIL import Image
-from torchvision.transforms import ToTensor
 
 from datasets.dataset_stick import StickDataset
 from datasets.interop import pascal_texture_planes
@@ -51,9 +49,15 @@ def get_planes(image: np.ndarray, meta, pascal_class: str,
 
 def warp_unwarp_planes(src_planes: np.ndarray, src_planes_kpoints: List[np.ndarray],
                        dst_planes_kpoints: List[np.ndarray],
-                       src_visibilities: np.ndarray, dst_visibilities: np.ndarray, pascal_class: str):
+                       src_visibilities: np.ndarray, dst_visibilities: np.ndarray, pascal_class: str,
+                       unwarp: bool = True):
+    """
+    Warp each source plane onto the destination keypoints and, if `unwarp` is set,
+     warp it back onto the source ones. When `unwarp` is False the second
+     homography and warp are skipped and `planes_unwarped` is None.
+    """
     planes_warped = np.zeros_like(src_planes, dtype=src_planes.dtype)
-    planes_unwarped = np.zeros_like(src_planes, dtype=src_planes.dtype)
+    planes_unwarped = np.zeros_like(src_planes, dtype=src_planes.dtype) if unwarp else None
 
     keys = list(pascal_texture_planes[pascal_class].keys())
     symmetry_set = [keys.index('left'), keys.index('right')]
@@ -81,10 +85,16 @@ def warp_unwarp_planes(src_planes: np.ndarray, src_planes_kpoints: List[np.ndarr
 
         dst_plane_kpoints = dst_planes_kpoints[j]
         H12, _ = cv2.findHomography(src_plane_kpoints, dst_plane_kpoints)
-        H21, _ = cv2.findHomography(dst_plane_kpoints, src_plane_kpoints)
+        if H12 is None:
+            continue
 
-        if H12 is not None and H21 is not None:
-            h, w = src_planes[0].shape[0:2]
+        h, w = src_planes[0].shape[0:2]
+        if not unwarp:
+            planes_warped[j] = cv2.warpPerspective(src_plane, H12, dsize=(h, w))
+            continue
+
+        H21, _ = cv2.findHomography(dst_plane_kpoints, src_plane_kpoints)
+        if H21 is not None:
             src_warped = cv2.warpPerspective(src_plane, H12, dsize=(h, w))
             src_unwarped = cv2.warpPerspective(src_warped, H21, dsize=(h, w))
 
@@ -274,8 +284,9 @@ class TextureDatasetWithNormal(StickDataset):
         """
         if to_LAB:
             x = cv2.cvtColor(x, cv2.COLOR_BGR2LAB)
-        x = Image.fromarray(x)
-        return self.normalizer(ToTensor()(x))
+        # Same as `Normalize(0.5, 0.5)(ToTensor()(x))`, without the PIL round-trip
+        x = torch.from_numpy(np.ascontiguousarray(x.transpose(2, 0, 1)))
+        return x.float().div_(127.5).sub_(1.)
 
     @staticmethod
     def planes_to_torch(planes, to_LAB: bool):
@@ -283,7 +294,7 @@ class TextureDatasetWithNormal(StickDataset):
         if to_LAB:
             planes = [cv2.cvtColor(p, cv2.COLOR_BGR2LAB) for p in planes]
         planes = np.stack(planes)
-        planes = np.float32(planes) / 255.
-        planes = np.transpose(planes, (0, 3, 1, 2))
-        planes = (torch.from_numpy(planes) - 0.5) / 0.5
-        return planes
+        planes = (np.float32(planes) / 255. - 0.5) / 0.5
+        # Contiguous (n_planes, C, H, W), so that callers can `view` it
+        planes = np.ascontiguousarray(np.transpose(planes, (0, 3, 1, 2)))
+        return torch.from_numpy(planes)
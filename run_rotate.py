@@ -2,25 +2,25 @@
 Open3D-based script to tinker with model predictions interactively.
 """
 import argparse
-import collections
+from collections.abc import Iterable
+from functools import lru_cache
 from pathlib import Path
 
 import cv2
 import numpy as np
 import open3d as o3d
 import torch
-from PIL import Image
-from torchvision.transforms import Normalize
-from torchvision.transforms import ToTensor
 
 from datasets.dataset_texture import TextureDatasetWithNormal
 from datasets.dataset_texture import get_planes
 from datasets.dataset_texture import warp_unwarp_planes
+from datasets.interop import pascal_texture_planes
 from model.von import G_Resnet
 from utils.geometry import intrinsic_matrix
 from utils.geometry import pascal_vpoint_to_extrinsics
 from utils.geometry import project_points
 from utils.misc import load_yaml_file
+from utils.normalization import lab_to_bgr
 from utils.normalization import to_image
 from utils.visibility import VisibilityOracle
 
@@ -43,6 +43,19 @@ def align_view(vis: o3d.VisualizerWithKeyCallback,
     vis.update_geometry()
 
 
+@lru_cache(maxsize=4096)
+def quantized_extrinsics(az_deg: int, el_deg: int, radius_cents: int) -> np.ndarray:
+    """
+    Memoized `pascal_vpoint_to_extrinsics` on a quantized viewpoint.
+    Radius is expressed in hundredths. Returned matrix is read-only as it is shared.
+    """
+    extrinsic = pascal_vpoint_to_extrinsics(az_deg=az_deg,
+                                            el_deg=el_deg,
+                                            radius=radius_cents / 100)
+    extrinsic.flags.writeable = False
+    return extrinsic
+
+
 class Geometries(dict):
     def __init__(self):
         super(Geometries, self).__init__()
@@ -50,7 +63,7 @@ class Geometries(dict):
     def as_list(self):
         l = []
         for v in self.values():
-            if isinstance(v, collections.Iterable):
+            if isinstance(v, Iterable):
                 l.extend(v)
             else:
                 l.append(v)
@@ -101,8 +114,15 @@ class Callbacks(object):
             state['radius'] -= 0.05
         # Next dataset example
         elif self.key == ord(' '):
-            state['texture_src'] = state['dataset'][state['dataset_index']]
+            texture_src = state['dataset'][state['dataset_index']]
             state['dataset_index'] += 1
+
+            # Source appearance does not change until next example, convert it once
+            texture_src['src_planes_bgr'] = np.asarray([to_image(i, from_LAB=args.LAB)
+                                                        for i in texture_src['planes']])
+            texture_src['src_central'] = texture_src['src_central'].to(args.device)
+            texture_src['src_image'] = texture_src['src_image'].to(args.device)
+            state['texture_src'] = texture_src
         # Next CAD model
         elif self.key == ord('N'):
             state['cad_idx'] += 1
@@ -117,41 +137,46 @@ class Callbacks(object):
             yaml_file = model_path.parent / (model_path.stem + '.yaml')
             state['kpoints_3d'] = load_yaml_file(yaml_file)['kpoints_3d']
 
+            # Stack 3D keypoints once so that they can be projected in a single call
+            kpoints_names, kpoints_3d = zip(*state['kpoints_3d'].items())
+            state['kpoints_names'] = kpoints_names
+            state['kpoints_3d_array'] = np.asarray(kpoints_3d)
+
             mesh = o3d.read_triangle_mesh(str(model_path))
 
             # Compute normal colors
             mesh.compute_vertex_normals()
-            state['normal_vertex_colors'] = (np.asarray(mesh.vertex_normals) + 1) / 2.
+            normal_vertex_colors = np.asarray(mesh.vertex_normals) * 0.5
+            normal_vertex_colors += 0.5
+            state['normal_vertex_colors'] = normal_vertex_colors
 
             if 'mesh' not in state['geometries']:
                 state['geometries']['mesh'] = mesh
             else:
                 state['geometries']['mesh'].vertices = mesh.vertices
-                state['geometries']['mesh'].vertex_colors = mesh.vertex_colors
                 state['geometries']['mesh'].vertex_normals = mesh.vertex_normals
                 state['geometries']['mesh'].triangles = mesh.triangles
 
+            # Set normal colors to the mesh
+            state['geometries']['mesh'].vertex_colors = o3d.Vector3dVector(state['normal_vertex_colors'])
+
         else:
             raise NotImplementedError()
 
-        # Set normal colors to the mesh
-        state['geometries']['mesh'].vertex_colors = o3d.Vector3dVector(state['normal_vertex_colors'])
-
         # Move Camera
-        angle_y = np.clip(state['angle_y'], -90, 90)
-        radius = np.clip(state['radius'], 0, state['radius'])
+        angle_y = max(-90., min(90., state['angle_y']))
+        radius = max(state['radius'], 0.)
 
         pascal_az = (state['angle_z'] + 90) % 360
         pascal_el = 90 - angle_y
 
-        intrinsic = intrinsic_matrix(state['focal'], cx=img_w/2, cy=img_h/2)
+        intrinsic = state['intrinsic']
 
         if args.verbose:
             print(f'Azimuth:{pascal_az} Elevation:{angle_y} Radius:{radius}')
 
-        extrinsic = pascal_vpoint_to_extrinsics(az_deg=pascal_az,
-                                                el_deg=pascal_el,
-                                                radius=radius)
+        vpoint_key = (int(pascal_az), int(pascal_el), int(round(radius * 100)))
+        extrinsic = quantized_extrinsics(*vpoint_key)
 
         if not vis.get_render_option() or not vis.get_view_control():
             vis.update_geometry()  # we don't have anything, return
@@ -162,72 +187,88 @@ class Callbacks(object):
         vis.get_render_option().background_color = (0, 0, 0)
 
         # Capture normal 2.5D sketch
-        src_normal = np.asarray(vis.capture_screen_float_buffer(do_render=True))
-        src_normal = (src_normal * 255).astype(np.uint8)
-        object_mask = np.all(src_normal == 0, axis=-1)
+        src_normal = state['normal_buf']
+        np.multiply(vis.capture_screen_float_buffer(do_render=True), 255,
+                    out=src_normal, casting='unsafe')
+        object_mask = (src_normal[..., 0] | src_normal[..., 1] | src_normal[..., 2]) == 0
 
         if args.LAB:
-            src_normal = cv2.cvtColor(src_normal, cv2.COLOR_RGB2LAB)
+            src_normal = cv2.cvtColor(src_normal, cv2.COLOR_RGB2LAB, dst=state['lab_buf'])
         else:
             raise ValueError('Released model was trained in LAB space.')
 
-        # Project model kpoints in 2D
-        kpoints_2d_step_dict = {}
-        for k_name, k_val in state['kpoints_3d'].items():
-            point_3d = np.asarray([k_val])
-            kpoints_2d_step = project_points(point_3d, intrinsic, extrinsic)
-            kpoints_2d_step /= (img_w, img_h)
-            kpoints_2d_step = np.clip(kpoints_2d_step, -1, 1)
-            kpoints_2d_step_dict[k_name] = kpoints_2d_step.squeeze(0)
-
-        meta = {
-            'kpoints_2d': kpoints_2d_step_dict,
-            'vpoint': [pascal_az, pascal_el],
-            'cad_idx': state['cad_idx']
-        }
-
-        dst_pl_info = get_planes(np.zeros((img_h, img_w, 3)),
-                                 meta=meta,
-                                 pascal_class=args.pascal_class,
-                                 vis_oracle=state['vis_oracle'])
-        _, dst_kpoints_planes, dst_visibilities = dst_pl_info
+        # Destination planes only depend on viewpoint and CAD: reuse them when
+        #  only the appearance changed (e.g. 'Space')
+        dst_planes_key = vpoint_key + (state['cad_idx'],)
+        if state['dst_planes_cache'] is not None and state['dst_planes_cache'][0] == dst_planes_key:
+            _, dst_kpoints_planes, dst_visibilities = state['dst_planes_cache']
+        else:
+            # Project model kpoints in 2D
+            kpoints_2d = project_points(state['kpoints_3d_array'], intrinsic, extrinsic)
+            kpoints_2d = np.clip(kpoints_2d / (img_w, img_h), -1, 1)
+            kpoints_2d_step_dict = dict(zip(state['kpoints_names'], kpoints_2d))
+
+            meta = {
+                'kpoints_2d': kpoints_2d_step_dict,
+                'vpoint': [pascal_az, pascal_el],
+                'cad_idx': state['cad_idx']
+            }
+
+            dst_pl_info = get_planes(np.zeros((img_h, img_w, 3)),
+                                     meta=meta,
+                                     pascal_class=args.pascal_class,
+                                     vis_oracle=state['vis_oracle'])
+            _, dst_kpoints_planes, dst_visibilities = dst_pl_info
+            state['dst_planes_cache'] = (dst_planes_key, dst_kpoints_planes, dst_visibilities)
 
         texture_src = state['texture_src']
-        src_planes = np.asarray([to_image(i, from_LAB=args.LAB) for i in texture_src['planes']])
+        src_planes = texture_src['src_planes_bgr']
         src_kpoints_planes = texture_src['src_kpoints_planes']
         src_visibilities = texture_src['src_vs']
 
-        planes_warped, planes_unwarped = warp_unwarp_planes(src_planes=src_planes,
-                                                            src_planes_kpoints=src_kpoints_planes,
-                                                            dst_planes_kpoints=dst_kpoints_planes,
-                                                            src_visibilities=src_visibilities,
-                                                            dst_visibilities=dst_visibilities,
-                                                            pascal_class=args.pascal_class)
+        planes_warped, _ = warp_unwarp_planes(src_planes=src_planes,
+                                              src_planes_kpoints=src_kpoints_planes,
+                                              dst_planes_kpoints=dst_kpoints_planes,
+                                              src_visibilities=src_visibilities,
+                                              dst_visibilities=dst_visibilities,
+                                              pascal_class=args.pascal_class,
+                                              unwarp=False)
 
         planes_warped = TextureDatasetWithNormal.planes_to_torch(planes_warped, to_LAB=args.LAB)
-        planes_warped = planes_warped.reshape(1, planes_warped.shape[0] * planes_warped.shape[1],
-                                              planes_warped.shape[2], planes_warped.shape[3])
-
-        src_sketch_input = Normalize(mean=[0.5]*3, std=[0.5]*3)(ToTensor()((Image.fromarray(src_normal))))
+        planes_host = state['planes_host']
+        planes_host.copy_(planes_warped.view(planes_host.shape))
+        planes_warped = planes_host.to(args.device, non_blocking=True)
+
+        # Normalize the sketch in range [-1, 1] directly into the pinned host buffer
+        sketch_host = state['sketch_host']
+        sketch_host.copy_(torch.from_numpy(src_normal).permute(2, 0, 1).unsqueeze(0))
+        sketch_host.div_(127.5).sub_(1.)
+        src_sketch_input = sketch_host.to(args.device, non_blocking=True)
         src_central = texture_src['src_central']
 
-        gen_in_src = torch.cat([src_sketch_input.unsqueeze(0), src_central.unsqueeze(0),
-                                planes_warped], dim=1).to(args.device)
+        gen_in_src = torch.cat([src_sketch_input, src_central.unsqueeze(0),
+                                planes_warped], dim=1)
 
-        net_image = to_image(state['net'](gen_in_src)[0], from_LAB=args.LAB)
+        # Half-precision inference on GPU, no autograd bookkeeping
+        with torch.inference_mode(), torch.autocast('cuda', enabled=args.device == 'cuda'):
+            net_out = state['net'](gen_in_src)
 
-        # Use the normal image to mask artifacts
-        net_image[object_mask] = 255
+        # Compose the output collage and convert it to BGR on device
+        out_image = torch.cat([src_sketch_input[0],
+                               src_central,
+                               net_out[0].float(),
+                               texture_src['src_image']], dim=2)
+        out_image = lab_to_bgr(out_image).mul_(255).round_().clamp_(0, 255).byte()
+        out_image_host = state['out_buf']
+        torch.from_numpy(out_image_host).copy_(out_image.permute(1, 2, 0))
+        out_image = out_image_host
 
-        out_image = np.concatenate([to_image(src_sketch_input, from_LAB=args.LAB),
-                                    to_image(src_central, from_LAB=args.LAB),
-                                    net_image,
-                                    to_image(texture_src['src_image'], from_LAB=args.LAB)],
-                                   axis=1)
+        # Use the normal image to mask artifacts
+        out_image[:, 2 * img_w:3 * img_w][object_mask] = 255
         state['dump_image'] = out_image
 
         cv2.imshow('Output', out_image)
-        cv2.waitKey(20)
+        cv2.waitKey(1)
         vis.update_geometry()
 
 
@@ -242,20 +283,51 @@ def run(args: argparse.Namespace):
         'angle_z': 0.,
         'cad_idx': 0,
         'dataset_index': 0,
+        'dst_planes_cache': None,
         'dump_id': 0,
         'focal': 1000,
         'geometries': Geometries(),
         'radius': 7
     }
 
+    # Focal and image size never change, neither does the intrinsic matrix
+    state['intrinsic'] = intrinsic_matrix(state['focal'], cx=img_w/2, cy=img_h/2)
+
     # Load pre-trained model
     input_nc = 21 if args.pascal_class == 'car' else 18
     net = G_Resnet(input_nc).to(args.device)
     net.load_state_dict(torch.load(args.model_path))
     net.eval()
 
+    # Specialize the generator for the fixed input shape used by the demo
+    example = torch.zeros(1, input_nc, img_h, img_w, device=args.device)
+    if hasattr(torch, 'compile'):
+        # `reduce-overhead` also replays the forward through CUDA graphs. On CPU
+        #  stay in eager mode: Inductor would need a C++ toolchain at startup
+        if args.device == 'cuda':
+            net = torch.compile(net, mode='reduce-overhead', fullgraph=True)
+    else:
+        with torch.no_grad():
+            net = torch.jit.optimize_for_inference(torch.jit.trace(net, example))
+
+    # Warm-up, so that compilation does not happen on first key press
+    with torch.inference_mode(), torch.autocast('cuda', enabled=args.device == 'cuda'):
+        net(example)
+
     state['net'] = net
 
+    # Host buffers for the network input, pinned to allow async copies to GPU
+    state['sketch_host'] = torch.empty((1, 3, img_h, img_w), pin_memory=args.device == 'cuda')
+    n_planes = len(pascal_texture_planes[args.pascal_class])
+    state['planes_host'] = torch.empty((1, n_planes * 3, img_h, img_w), pin_memory=args.device == 'cuda')
+
+    # Captured normal sketch
+    state['normal_buf'] = np.empty((img_h, img_w, 3), dtype=np.uint8)
+    state['lab_buf'] = np.empty((img_h, img_w, 3), dtype=np.uint8)
+
+    # Output collage (sketch, central crop, prediction, source image)
+    state['out_buf'] = np.empty((img_h, img_w * 4, 3), dtype=np.uint8)
+
     # Load test dataset
     dataset = TextureDatasetWithNormal(dataset_dir=args.texture_dataset_dir,
                                        visibility_dir=args.CAD_root,
@@ -1,3 +1,4 @@
+from functools import lru_cache
 from typing import Union
 
 import cv2
@@ -54,6 +55,54 @@ def to_image(x: Union[np.ndarray, torch.Tensor], from_LAB: bool):
     return x
 
 
+# CIE XYZ (D65) -> linear sRGB, same coefficients used by OpenCV
+_XYZ_TO_RGB = ((3.240479, -1.53715, -0.498535),
+               (-0.969256, 1.875991, 0.041556),
+               (0.055648, -0.204043, 1.057311))
+_D65_WHITE = (0.950456, 1., 1.088754)
+
+
+@lru_cache(maxsize=None)
+def _lab_to_bgr_constants(device: torch.device):
+    """
+    Colorspace constants for `lab_to_bgr`, uploaded once per device.
+    """
+    white = torch.tensor(_D65_WHITE, device=device).view(3, 1, 1)
+    xyz_to_rgb = torch.tensor(_XYZ_TO_RGB, device=device)
+    return white, xyz_to_rgb
+
+
+def lab_to_bgr(x: torch.Tensor):
+    """
+    Convert a LAB tensor to BGR using torch ops only, so that it can run on GPU.
+
+    This mirrors `to_image(x, from_LAB=True)` (i.e. `cv2.COLOR_LAB2BGR` on 8-bit
+     LAB) without leaving the device the tensor lives on. Output must be
+     rounded (not truncated) when cast to uint8 to match OpenCV.
+
+    :param x: LAB tensor of shape (3, H, W) in range [-1, 1]
+    :return x: BGR tensor of shape (3, H, W) in range [0, 1]
+    """
+    assert len(x.shape) == 3, f'Unsupported image shape {x.shape}'
+
+    # Quantize as the uint8 cast in `to_image` does before `cv2.cvtColor`
+    x = ((x.float() + 1.) / 2 * 255).clamp(0, 255).floor_()
+
+    # 8-bit LAB encoding: L in [0, 255] -> [0, 100], a and b are offset by 128
+    fy = (x[0] * (100. / 255) + 16.) / 116.
+    f = torch.stack([fy + (x[1] - 128.) / 500., fy, fy - (x[2] - 128.) / 200.])
+
+    delta = 6. / 29
+    xyz = torch.where(f > delta, f ** 3, 3 * delta ** 2 * (f - 4. / 29))
+    white, xyz_to_rgb = _lab_to_bgr_constants(x.device)
+    xyz = xyz * white
+
+    rgb = torch.tensordot(xyz_to_rgb, xyz, dims=1)
+    rgb = rgb.clamp(0, 1)
+    rgb = torch.where(rgb > 0.0031308, 1.055 * rgb ** (1 / 2.4) - 0.055, 12.92 * rgb)
+    return rgb.flip(0)
+
+
 def planes_to_image(planes: torch.Tensor, from_LAB=False):
     """
     Given a planes tensor of shape (B, n_planes * 3, H, W) return a